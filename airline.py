@@ -1,46 +1,67 @@
 # -*- coding: utf-8 -*-
 
-from collections import namedtuple
 from configparser import ConfigParser
+from dataclasses import dataclass, fields
 from datetime import timedelta
 from datetime import date, time, datetime
 from json import dumps, loads
-from urllib import parse
+import asyncio
+import functools
 import itertools
 import operator
 import re
 
+from lxml import etree
 from lxml import html
-import cachetools
+from lxml.cssselect import CSSSelector
+import aiohttp
+import cachetools.func
 import cssselect
-import requests
+import diskcache
+import orjson
 
-from util import flatten
-from util import meridian
 from util import tomorrow
 
 config_file = "config.ini"
+cache_dir = ".cache"
+# Seconds a scraped route stays valid on disk
+cache_ttl = 600
 
+css_to_xpath = cssselect.HTMLTranslator().css_to_xpath
 
-class FlightInfo(namedtuple("FlightInfo", [
-    "origin",
-    "destination",
-    "depart_date",
-    "carrier",
-    "booking_link",
-    "is_early",
-    "depart_time",
-    "arrive_time",
-    "flight_no",
-    "fare"
-])):
-    pass
+time_re = re.compile(r"\s*(\d{1,2}):(\d{2})\s*([AP])M?", re.IGNORECASE)
+
+
+# Sites only ever show a few dozen distinct times, and time is immutable.
+@functools.lru_cache(maxsize=256)
+def _parse_time_cached(time_string):
+    hour, minute, indicator = time_re.match(time_string).groups()
+
+    # 12 AM is midnight and 12 PM is noon, hence the modulo.
+    return time(hour=int(hour) % 12 + (12 if indicator.upper() == 'P' else 0), minute=int(minute))
+
+
+@dataclass(frozen=True, slots=True)
+class FlightInfo:
+    origin: str
+    destination: str
+    depart_date: date
+    carrier: str
+    booking_link: str
+    is_early: bool
+    depart_time: time
+    arrive_time: time
+    flight_no: str
+    fare: int
+
+    def __iter__(self):
+        # Still unpacks (and serializes) positionally like the old namedtuple
+        return (getattr(self, f.name) for f in fields(self))
 
 class Weekender:
     def __init__(self, config):
         self.config = config
-        self.ar = AirlineRegistry
-        self.ar.instantiate(config)
+        self.airlines = [airline(config) for airline in AirlineBase.registry]
 
         self.leave_after = self._parse_time(config['general']['leave_after'])
         self.leave_before = self._parse_time(config['general']['leave_before'])
@@ -49,65 +70,77 @@ class Weekender:
         hour, minute = time_string.split(":")
         return time(hour=int(hour), minute=int(minute))
 
-    @cachetools.ttl_cache()
+    @cachetools.func.ttl_cache(maxsize=1024, ttl=300)
     def request_with_next(self, date, reverse=False):
         day = self.request(date, operator.gt, self.leave_after, reverse=reverse, early=False)
         day_after = self.request(date + timedelta(days=1), operator.lt, self.leave_before, reverse=reverse, early=True)
 
-        return flatten([day, day_after])
+        return [*day, *day_after]
 
     def request(self, date, cmp, filter_bound, reverse=False, early=False):
-        result = self.ar.request_all(date, reverse=reverse, early=early)
+        result = asyncio.run(self.request_all(date, reverse=reverse, early=early))
 
-        result = [fi for fi in result if cmp(fi.depart_time, filter_bound)]
+        return [fi for fi in result if cmp(fi.depart_time, filter_bound)]
 
-        return result
+    async def request_single(self, origin, destination, date, early=False):
+        results = await asyncio.gather(*[
+            airline.request_single(origin, destination, date, early=early)
+            for airline in self.airlines
+        ])
+        return itertools.chain.from_iterable(results)
 
-class AirlineRegistry(type):
-    classes = []
-    airlines = []
-    done = False
+    async def request_all(self, date, reverse=False, early=False):
+        results = await asyncio.gather(*[
+            airline.request_all(date, reverse=reverse, early=early)
+            for airline in self.airlines
+        ])
+        return itertools.chain.from_iterable(results)
 
-    def __new__(cls, name, bases, attrs):
-        new_cls = type.__new__(cls, name, bases, attrs)
+class AirlineBase:
+    # Every concrete airline, in definition order
+    registry = []
 
-        if bases is not ():
-            cls.classes.append(new_cls)
+    # Results pages by default; JSON APIs override this.
+    accept = "text/html,application/xhtml+xml"
 
-        return new_cls
+    # Comments, PIs and the id table are never looked at by the extractors,
+    # so don't spend time building them for every results page.
+    html_parser = html.HTMLParser(remove_comments=True, remove_pis=True, collect_ids=False)
 
-    @classmethod
-    def instantiate(cls, config):
-        if cls.done:
-            return
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        AirlineBase.registry.append(cls)
 
-        cls.airlines = [airline(config) for airline in cls.classes]
-        cls.done = True
-
-    @classmethod
-    def request_single(cls, origin, destination, date):
-        results = [airline.request_single(origin, destination, date) for airline in cls.airlines]
-        return flatten(results)
-
-    @classmethod
-    def request_all(cls, date, reverse=False, early=False):
-        results = [airline.request_all(date, reverse=reverse, early=early) for airline in cls.airlines]
-        return flatten(results)
-
-class AirlineBase(metaclass=AirlineRegistry):
     def __init__(self, config):
         self.config = config
-        self.s = requests.session()
+        # Survives restarts, unlike the ttl_cache on Weekender.request_with_next
+        self.cache = diskcache.Cache(cache_dir)
 
         # Just in case
-        self.s.headers['User-Agent'] = "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/40.0.2214.91 Safari/537.36"
-        self.s.headers['Referer'] = self.endpoint
+        self.headers = {
+            'User-Agent': "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/40.0.2214.91 Safari/537.36",
+            'Referer': self.endpoint,
+            'Accept': self.accept,
+            # br is only decoded when Brotli is installed, hence requirements.txt
+            'Accept-Encoding': "gzip, deflate, br",
+        }
+
+    def session(self):
+        """Sessions are bound to the running event loop, so one is opened per
+        scan rather than held on the instance.
+
+        Error statuses raise, so a 503 never reaches the disk cache as an
+        empty result."""
+        return aiohttp.ClientSession(headers=self.headers, raise_for_status=True)
 
-    def resp_to_html(self, resp):
-        return html.fromstring(resp.text)
+    async def resp_to_html(self, resp):
+        # Hand libxml2 the raw bytes; it sniffs the charset itself and we skip
+        # decoding the whole page into a str first.
+        return html.fromstring(await resp.read(), parser=self.html_parser)
 
     def elem_sel_to_text(self, elem, sel, sep=''):
-        return sep.join([sub.text_content() for sub in elem.cssselect(sel)])
+        """sel is a compiled selector, e.g. a CSSSelector or etree.XPath."""
+        return sep.join([sub.text_content() for sub in sel(elem)])
 
     @property
     def origins(self):
@@ -121,38 +154,55 @@ class AirlineBase(metaclass=AirlineRegistry):
                 if self.__class__.__name__ in self.config
                 else [])
 
-    def request_all(self, date, reverse=False, early=False):
+    def _routes(self, reverse=False):
         if reverse:
-            product = itertools.product(self.destinations, self.origins)
+            yield from itertools.product(self.destinations, self.origins)
         else:
-            product = itertools.product(self.origins, self.destinations)
+            yield from itertools.product(self.origins, self.destinations)
 
-        results = [
-            self.request_single(origin, destination, date, early=early)
-            for origin, destination
-            in product
-        ]
+    async def request_all(self, date, reverse=False, early=False):
+        # Same date for every route, so only format it once.
+        formatted_date = date.strftime(self.date_format)
 
-        return flatten(results)
+        async with self.session() as s:
+            results = await asyncio.gather(*[
+                self.request_single(origin, destination, date, early=early, s=s, formatted_date=formatted_date)
+                for origin, destination
+                in self._routes(reverse)
+            ])
 
-    def request_single(self, origin, destination, date, early):
-        formatted_date = date.strftime(self.date_format)
+        return itertools.chain.from_iterable(results)
+
+    async def request_single(self, origin, destination, date, early, s=None, formatted_date=None):
+        key = (self.__class__.__name__, origin, destination, date.isoformat(), early)
+        flightinfos = self.cache.get(key)
+        if flightinfos is not None:
+            return flightinfos
 
-        data = self.fixed_data.copy()
-        data.update({
+        if s is None:
+            async with self.session() as s:
+                return await self.request_single(origin, destination, date, early, s=s, formatted_date=formatted_date)
+
+        if formatted_date is None:
+            formatted_date = date.strftime(self.date_format)
+
+        data = {
+            **self.fixed_data,
             self.dynamic_fields['origin']: origin,
             self.dynamic_fields['destination']: destination,
             self.dynamic_fields['formatted_date']: formatted_date,
-        })
+        }
 
-        rows = self._request_single(origin, destination, date, early, data)
+        rows = await self._request_single(s, origin, destination, date, early, data)
 
         flightinfos = [self.extract_row_to_flightinfo(row, origin, destination, date, early) for row in rows]
         flightinfos = [fi for fi in flightinfos if fi is not None]
 
+        self.cache.set(key, flightinfos, expire=cache_ttl)
+
         return flightinfos
 
-    def _request_single(self, origin, destination, date, early):
+    async def _request_single(self, s, origin, destination, date, early, data):
         """Each subclass should implement this."""
         raise NotImplementedError
 
@@ -166,14 +216,10 @@ class AirlineBase(metaclass=AirlineRegistry):
         )
 
     def _parse_time_string(self, time_string):
-        numbers, indicator = time_string.split(" ")
-        hour, minute = numbers.split(":")
-        hour = int(hour)
-        minute = int(minute)
-
-        hour = meridian(hour, indicator)
-
-        return time(hour=hour, minute=minute)
+        """Parse a 12-hour clock string such as "6:05 PM"."""
+        # Callers pass lxml XPath string results; normalize them to plain str
+        # so cache keys are uniform.
+        return _parse_time_cached(str(time_string))
 
     def _parse_iso_datetime_string(self, datetime_string):
         """Parse ISO8601 with strptime because lol."""
@@ -220,57 +266,54 @@ class Southwest(AirlineBase):
         'formatted_date': 'outboundDateString',
     }
 
-    def _request_single(self, origin, destination, date, early, data):
-        r = self.s.post(self.endpoint, data=data)
-        doc = self.resp_to_html(r)
-        rows = doc.cssselect(".searchResultsTable > tbody > tr")
+    # Rows without the Wanna Get Away <td> are sold out, so drop them here.
+    rows_xp = etree.XPath("descendant-or-self::table[contains(concat(' ', normalize-space(@class), ' '), ' searchResultsTable ')]/tbody/tr[count(td) >= 8]")
+    # Cells are pulled straight off the row as strings; $col is the 1-based td.
+    # "6:05" and "PM" live in separate spans; concat() joins them in libxml2.
+    time_xp = etree.XPath("concat(string(td[$col]/{}), ' ', string(td[$col]/{}))".format(
+        css_to_xpath(".time", prefix="descendant::"),
+        css_to_xpath(".indicator", prefix="descendant::"),
+    ))
+    flight_xp = etree.XPath("td[3]/{}".format(css_to_xpath(".bugLinkText", prefix="descendant::")))
+    price_xp = etree.XPath("string(td[8]/{})".format(css_to_xpath(".product_price", prefix="descendant::")))
+    # Fares over $999 come with a thousands separator, e.g. "$1,029"
+    fare_re = re.compile(r"\$?(\d[\d,]*)")
+
+    async def _request_single(self, s, origin, destination, date, early, data):
+        async with s.post(self.endpoint, data=data) as r:
+            doc = await self.resp_to_html(r)
+        rows = self.rows_xp(doc)
 
         return rows
 
     def extract_row_to_flightinfo(self, row, origin, destination, date, is_early):
         # Depart, arrive, flight number, Wanna Get Away fare
-        to_extract = {
-            0: self._col_time,
-            1: self._col_time,
-            2: self._col_flight,
-            7: self._col_fare,
-        }
-
-        # Only top level td
-        cols = row.xpath("td")
+        m = self.fare_re.search(self.price_xp(row))
 
-        if len(cols) < 8:  # Wanna Get Away <td> isn't there at all. All fares are sold out
+        if m is None:
             return None
 
-        row_extracted_data = [to_extract[i](col) for i, col in enumerate(cols) if i in to_extract.keys()]
+        flight_number = self.elem_sel_to_text(row, self.flight_xp, sep='/')
 
-        interested_cols = \
-            [origin, destination, date, self.carrier, self._google_flights_link(origin, destination, date, self.carrier, row_extracted_data[2]), is_early] + \
-            row_extracted_data
-
-        fi = FlightInfo(*interested_cols)
-
-        if fi.fare is None:
-            return None
+        fi = FlightInfo(
+            origin,
+            destination,
+            date,
+            self.carrier,
+            self._google_flights_link(
+                origin, destination, date, self.carrier, flight_number,
+            ),
+            is_early,
+            self._col_time(row, 1),
+            self._col_time(row, 2),
+            flight_number,
+            int(m.group(1).replace(',', '')),
+        )
 
         return fi
 
-    def _col_time(self, col):
-        time_string = self.elem_sel_to_text(col, ".time")
-        indicator = self.elem_sel_to_text(col, ".indicator")
-
-        return self._parse_time_string(time_string + ' ' + indicator)
-
-    def _col_flight(self, col):
-        return self.elem_sel_to_text(col, ".bugLinkText", sep='/')
-
-    def _col_fare(self, col):
-        fare = self.elem_sel_to_text(col, ".product_price").strip(' \n\t$')
-
-        if fare == '':
-            return None
-
-        return int(fare)
+    def _col_time(self, row, col):
+        return self._parse_time_string(self.time_xp(row, col=col))
 
 class JetBlue(AirlineBase):
     carrier = 'B6'
@@ -299,33 +342,43 @@ class JetBlue(AirlineBase):
         'formatted_date': 'departureDate',
     }
 
-    def _request_single(self, origin, destination, date, early, data):
-        r = self.s.post(self.endpoint, data=data)
-        pr = parse.urlparse(r.url)
-        params = parse.parse_qs(pr.query)
-
-        r = self.s.get(self.endpoint, params={
+    rows_xp = etree.XPath("descendant-or-self::*[contains(concat(' ', normalize-space(@class), ' '), ' flight-row ')]")
+    # Only the first departure and last arrival are wanted, so let libxml2
+    # pick them out instead of materializing every <time> in the row.
+    from_time_xp = etree.XPath("({})[1]".format(css_to_xpath(".from time")))
+    to_time_xp = etree.XPath("({})[last()]".format(css_to_xpath(".to time")))
+    flight_number_sel = CSSSelector(".flight-number")
+    fare_sel = CSSSelector(".fare.non-refund .label")
+
+    async def _request_single(self, s, origin, destination, date, early, data):
+        async with s.post(self.endpoint, data=data) as r:
+            flow_execution_key = r.url.query['_flowExecutionKey']
+            # Drain the landing page so the connection goes back to the pool
+            # for the GET below instead of being closed.
+            await r.read()
+
+        async with s.get(self.endpoint, params={
             "_eventId": "getAsyncSearchResult",
-            "_flowExecutionKey": params['_flowExecutionKey'],
-        })
+            "_flowExecutionKey": flow_execution_key,
+        }) as r:
+            doc = await self.resp_to_html(r)
 
-        doc = self.resp_to_html(r)
-        rows = doc.cssselect(".flight-row")[1:]
+        rows = self.rows_xp(doc)[1:]
 
         return rows
 
     def extract_row_to_flightinfo(self, row, origin, destination, date, is_early):
         # JetBlue just adds multiple times instead of putting the combined time
-        depart_time = row.cssselect(".from time")[0].text_content()
+        depart_time = self.from_time_xp(row)[0].text_content()
         depart_time = self._parse_time_string(depart_time)
 
-        arrive_time = row.cssselect(".to time")[-1].text_content()
+        arrive_time = self.to_time_xp(row)[0].text_content()
         arrive_time = self._parse_time_string(arrive_time)
 
-        flight_numbers = [elem.text_content().split(" ")[1] for elem in row.cssselect(".flight-number")]
+        flight_numbers = [elem.text_content().split(" ")[1] for elem in self.flight_number_sel(row)]
         flight_number = '/'.join(flight_numbers)
 
-        fare = int(self.elem_sel_to_text(row, ".fare.non-refund .label").strip(' \r\n\t$'))
+        fare = int(self.elem_sel_to_text(row, self.fare_sel).strip(' \r\n\t$'))
 
         # TODO: Need more checks here
         fi = FlightInfo(
@@ -370,29 +423,38 @@ class United(AirlineBase):
         'formatted_date': 'DepartDate',
     }
 
-    def _request_single(self, origin, destination, date, early, data):
-        r = self.s.post(self.endpoint, data=data, cookies={'AspxAutoDetectCookieSupport': '1'})
+    rows_xp = etree.XPath("descendant-or-self::ul[@data-role='listview']")
+    carrier_xp = etree.XPath(".//img[@alt='carrier logo']/..")
+    pick_trip_sel = CSSSelector("#btnPickTrip")
+    # $label is bound per call, so one compiled expression serves every label.
+    label_info_xp = etree.XPath(".//label[@for=$label]/../following-sibling::div")
+    # "UA 1234", possibly padded with whitespace
+    flight_re = re.compile(r"\s*(\S+)\s+(\S+)")
+    fare_re = re.compile(r"\$(\d[\d,]*)")
 
-        doc = self.resp_to_html(r)
-        rows = doc.cssselect("ul[data-role='listview']")[:-1]
+    async def _request_single(self, s, origin, destination, date, early, data):
+        async with s.post(self.endpoint, data=data, cookies={'AspxAutoDetectCookieSupport': '1'}) as r:
+            doc = await self.resp_to_html(r)
+
+        rows = self.rows_xp(doc)[:-1]
 
         return rows
 
     def _extract_time_for_label(self, row, label):
         # This is disgusting.
-        info = row.xpath(".//label[@for='{}']/../following-sibling::div".format(label))[0].text_content()
+        info = self.label_info_xp(row, label=label)[0].text_content()
         time_string, _, _ = [text.strip() for text in info.strip('\t\r\n').split('\r\n')]
         return self._parse_time_string(time_string)
 
     def extract_row_to_flightinfo(self, row, origin, destination, date, is_early):
-        _, flight_number = row.xpath(".//img[@alt='carrier logo']/..")[0].text_content().strip().split(' ')
+        flight_number = self.flight_re.match(self.carrier_xp(row)[0].text_content()).group(2)
 
         depart_time = self._extract_time_for_label(row, 'DepartureAirportName')
         arrive_time = self._extract_time_for_label(row, 'ArrivalAirportName')
 
-        fare_button = row.cssselect('#btnPickTrip')[0].attrib['value']
-        m = re.search("\$(\d+)", fare_button)
-        fare = int(m.group(1))
+        fare_button = self.pick_trip_sel(row)[0].attrib['value']
+        m = self.fare_re.search(fare_button)
+        fare = int(m.group(1).replace(',', ''))
 
         # TODO: What is error checking? Hello? Bueller?
         fi = FlightInfo(
@@ -415,6 +477,7 @@ class United(AirlineBase):
 class VirginAmerica(AirlineBase):
     carrier = 'VX'
     endpoint = "https://www.virginamerica.com/api/v0/booking/search"
+    accept = "application/json"
     date_format = '%Y-%m-%d'
 
     fixed_data = {
@@ -428,12 +491,13 @@ class VirginAmerica(AirlineBase):
         'formatted_date': 'departureDate',
     }
 
-    def _request_single(self, origin, destination, date, early, data):
+    async def _request_single(self, s, origin, destination, date, early, data):
         data['returningDate'] = data['departureDate']
-        r = self.s.post(self.endpoint, json={'roundTrip': data})
-        d = r.json()
+        async with s.post(self.endpoint, json={'roundTrip': data}) as r:
+            d = orjson.loads(await r.read())
         if d['status']['status'] != 'SUCCESS':
-            return []
+            # Raise rather than return [], which would be cached as "no flights".
+            raise ValueError("Virgin America search failed: {}".format(d['status']))
         if not d['response']['departingFlightsInfo']['flightList']:
             return []
 
@@ -472,6 +536,6 @@ if __name__ == '__main__':
 
     from datetime import date
     vx = VirginAmerica(config)
-    print(vx.request_single('LAX', 'SFO', date(2015,5,20), early=False))
+    print(asyncio.run(vx.request_single('LAX', 'SFO', date(2015,5,20), early=False)))
     #w = Weekender(config)
     #print(w.request(date(2015, 2, 20)))
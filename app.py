@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from configparser import ConfigParser
 from operator import attrgetter
+import itertools
 import json
 
 from flask import Flask
@@ -10,7 +11,6 @@ from flask import request
 
 from util import WeekenderEncoder
 from util import bound_weekend
-from util import flatten
 from util import parse_date
 import airline
 
@@ -37,17 +37,17 @@ def flights():
         })
 
     begin_results = sorted(
-        flatten([
+        itertools.chain.from_iterable(
             weekender.request_with_next(origin_day)
             for origin_day in origin_days
-        ]),
+        ),
         key=attrgetter('fare'),
     )
     end_results = sorted(
-        flatten([
+        itertools.chain.from_iterable(
             weekender.request_with_next(return_day, reverse=True)
             for return_day in return_days
-        ]),
+        ),
         key=attrgetter('fare'),
     )
 
@@ -1,4 +1,5 @@
 # -*- cofding: utf-8 -*-
+from dataclasses import is_dataclass
 from datetime import date
 from datetime import time
 from datetime import timedelta
@@ -6,10 +7,6 @@ from json import JSONEncoder
 import re
 
 
-def flatten(lol):
-    return [item for lst in lol for item in lst]
-
-
 def parse_date(date_string):
     if not date_string:
         return None
@@ -83,18 +80,12 @@ def tomorrow(date_obj):
     return date_obj + timedelta(days=1)
 
 
-def meridian(hour, indicator):
-    if indicator == "AM" and hour == 12:
-        hour = 0
-    if indicator == "PM" and hour < 12:
-        hour += 12
-
-    return hour
-
-
 class WeekenderEncoder(JSONEncoder):
 
     def default(self, obj):
+        if is_dataclass(obj):
+            # The frontend reads flights as positional arrays.
+            return list(obj)
         if isinstance(obj, date):
             # Yes, this is not the representation that comes in.
             return obj.strftime('%a %Y/%m/%d')